@@ -0,0 +1,69 @@
+import asyncio
+import db_conn
+from wb_api_async import AsyncWBApiConn, new_http_session
+
+# Writer driven by asyncio: API calls are awaited in event loop, while
+# blocking MySQL writes are offloaded to default thread pool
+class AsyncWriter(db_conn.Writer):
+    def __init__(self, token, user_id, run_number=0, http=None, write_mode='replace'):
+        super().__init__(token, user_id, run_number, write_mode=write_mode)
+        self.conn = AsyncWBApiConn(token, http)
+
+    async def update_data(self):
+        print("Updating data...")
+
+        # independent endpoints run at once (at most endpoint_workers),
+        # dependent one waits for tasks of its dependencies
+        semaphore = asyncio.Semaphore(self.endpoint_workers)
+        tasks = {}
+        for name, table, fetch, after in self.endpoints():
+            depends = [tasks[dep] for dep in after if dep in tasks]
+            tasks[name] = asyncio.ensure_future(self.update_endpoint(name, table, fetch, depends, semaphore))
+        await asyncio.gather(*tasks.values())
+
+        print('Done!')
+
+    async def update_endpoint(self, name, table, fetch, depends, semaphore):
+        await asyncio.gather(*depends)
+        async with semaphore:
+            print(f'Getting {name}...')
+            try:
+                # write every page as soon as it arrives
+                async for data in fetch():
+                    await self.db_call(self.write_page, table, data)
+                await self.db_call(self.commit_progress, table)
+            except Exception as e:
+                print(f'Error while getting {name}: {e}, skipping...')
+
+    # Write page and save progress after it, in one DB call
+    def write_page(self, table, data):
+        self.multi_insert(table, data)
+        self.commit_progress(table)
+
+    # Run blocking DB function in thread with connection from pool,
+    # returned right after the call
+    async def db_call(self, func, *args):
+        def call():
+            with db_conn.mysql_db.connection_context():
+                return func(*args)
+        return await asyncio.to_thread(call)
+
+    async def run(self):
+        await self.db_call(self.init_tables)
+        await self.db_call(self.load_watermarks)
+        await self.db_call(self.load_backfill_chunks)
+        await self.update_data()
+
+
+# Run writers for all API keys in one event loop, at most 'concurrency' at once
+async def run_writers(api_keys, concurrency=1000, http_config=None, write_mode='replace'):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with new_http_session(**(http_config or {})) as http:
+        async def run_one(obj):
+            async with semaphore:
+                writer = AsyncWriter(obj.api_key, obj.user_id, obj.runs, http, write_mode)
+                await writer.run()
+                await asyncio.to_thread(db_conn.count_run, obj.key_id)
+
+        await asyncio.gather(*(run_one(obj) for obj in api_keys))
@@ -0,0 +1,78 @@
+import threading
+
+# Per-column overhead in INSERT statement: placeholder, separators, quotes, NULL
+COLUMN_OVERHEAD = 8
+
+
+# Estimated size of row in INSERT statement, in characters.
+# Non-ASCII text takes up to 2x more bytes, that's taken into account by
+# keeping batches under half of max_allowed_packet
+def row_size(row):
+    return len(row) * COLUMN_OVERHEAD + sum(len(value) for value in row if type(value) is str)
+
+
+# Splits rows of one table into batches by estimated bytes instead of fixed
+# row count, so wide rows (cards with descriptions) don't exceed
+# max_allowed_packet and narrow rows (promos) go in big batches.
+# Target size is tuned by latency of written batches.
+class AdaptiveBatcher:
+    def __init__(self, max_packet=4 * 1024 * 1024, target=1024 * 1024, min_target=64 * 1024,
+                 latency=1.0):
+        self.max_packet = max_packet
+        self.target = target
+        self.min_target = min_target
+        # desired time of one batch, in seconds
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def limit(self):
+        return min(self.target, self.max_packet // 2)
+
+    # Yields (batch, estimated size); batch has at least one row
+    def batches(self, rows):
+        limit = self.limit()
+        batch, size = [], 0
+        for row in rows:
+            row_bytes = row_size(row)
+            if batch and size + row_bytes > limit:
+                yield batch, size
+                batch, size = [], 0
+            batch.append(row)
+            size += row_bytes
+        if batch:
+            yield batch, size
+
+    # Feedback from written batch: grow target while batches are fast,
+    # shrink it when they're slow
+    def record(self, size, seconds):
+        with self.lock:
+            if size < self.target / 2:
+                # batch was limited by rows count, not by target: nothing to learn
+                return
+            if seconds < self.latency / 2:
+                self.target = min(int(self.target * 1.25), self.max_packet // 2)
+            elif seconds > self.latency:
+                self.target = max(int(self.target * 0.7), self.min_target)
+
+
+_batchers = {}
+_lock = threading.Lock()
+# max_allowed_packet of server, read once per process
+max_packet = None
+
+
+def init_max_packet(database):
+    global max_packet
+    if max_packet is None:
+        max_packet = int(database.execute_sql('SELECT @@max_allowed_packet').fetchone()[0])
+
+
+# Batcher of table, shared by all writers
+def batcher_for(table):
+    with _lock:
+        batcher = _batchers.get(table)
+        if batcher is None:
+            batcher = _batchers[table] = AdaptiveBatcher()
+            if max_packet is not None:
+                batcher.max_packet = max_packet
+        return batcher
@@ -0,0 +1,78 @@
+import json
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+from dateutil import parser
+import fast_json
+
+# Benchmark of JSON decoding and date parsing paths (see fast_json.py).
+# Usage: python bench_json.py [recorded reportDetailByPeriod response .json]
+# Without file, a response of 100k rows like reportDetailByPeriod is generated.
+
+
+def financial_fixture(rows=100000):
+    start = datetime(2024, 1, 29)
+    result = []
+    for i in range(rows):
+        row = {'realizationreport_id': 1000 + i // 1000, 'rrd_id': i + 1,
+               'date_from': '2024-01-29T00:00:00Z', 'date_to': '2024-02-04T00:00:00Z',
+               'create_dt': (start + timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%S'),
+               'currency_name': 'руб', 'suppliercontract_code': None, 'gi_id': 12345678,
+               'subject_name': 'Футболки', 'nm_id': 100000 + i % 5000, 'brand_name': 'Brand',
+               'sa_name': f'SA-{i % 5000}', 'ts_name': 'M', 'barcode': f'20000{i % 5000:08d}',
+               'doc_type_name': 'Продажа', 'quantity': 1, 'retail_price': 1999.0,
+               'retail_amount': 1499.25, 'sale_percent': 25, 'commission_percent': 17.5,
+               'office_name': 'Коледино', 'supplier_oper_name': 'Продажа',
+               'order_dt': '2024-01-29T10:15:00Z', 'sale_dt': '2024-01-30T12:00:00Z',
+               'rr_dt': '2024-01-30', 'shk_id': 9000000000 + i, 'retail_price_withdisc_rub': 1499.25,
+               'delivery_amount': 0, 'return_amount': 0, 'delivery_rub': 0.0,
+               'gi_box_type_name': 'Монопаллета', 'product_discount_for_report': 25.0,
+               'supplier_promo': 0.0, 'rid': 0, 'ppvz_spp_prc': 10.0, 'ppvz_kvw_prc_base': 17.5,
+               'ppvz_kvw_prc': 15.0, 'ppvz_sales_commission': 200.5, 'ppvz_for_pay': 1200.75,
+               'ppvz_reward': 0.0, 'acquiring_fee': 15.0, 'acquiring_bank': 'Банк',
+               'ppvz_vw': 180.0, 'ppvz_vw_nds': 36.0, 'ppvz_office_id': 507, 'ppvz_office_name': '',
+               'ppvz_supplier_id': 0, 'ppvz_supplier_name': '', 'ppvz_inn': '', 'declaration_number': '',
+               'bonus_type_name': '', 'sticker_id': '1234567890', 'site_country': 'Россия',
+               'penalty': 0.0, 'additional_payment': 0.0, 'rebill_logistic_cost': 0.0,
+               'storage_fee': 0.0, 'deduction': 0.0, 'acceptance': 0.0, 'srid': f'srid{i}'}
+        result.append(row)
+    return json.dumps(result, ensure_ascii=False).encode()
+
+
+def timed(name, func, repeat=3):
+    best = min(measure(func) for _ in range(repeat))
+    print(f'{name:<45} {best * 1000:9.1f} ms')
+    return best
+
+
+def measure(func):
+    start = perf_counter()
+    func()
+    return perf_counter() - start
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as file:
+            content = file.read()
+    else:
+        content = financial_fixture()
+    print(f'response: {len(content) / 1024 / 1024:.1f} MB')
+
+    base = timed('json.loads (requests Response.json)', lambda: json.loads(content))
+    if fast_json.orjson is not None:
+        fast = timed('orjson.loads', lambda: fast_json.orjson.loads(content))
+        print(f'  x{base / fast:.1f}')
+    else:
+        print('orjson is not installed, fast path falls back to json.loads')
+    timed('fast_json.iter_array, pages of 10000', lambda: sum(len(page) for page in
+                                                             fast_json.iter_array(content, 10000)))
+
+    dates = [row.get('order_dt') or '2024-01-29T10:15:00Z' for row in json.loads(content)]
+    base = timed('dateutil.parser.parse', lambda: [parser.parse(value) for value in dates], 1)
+    fast = timed('fast_json.parse_iso', lambda: [fast_json.parse_iso(value) for value in dates])
+    print(f'  x{base / fast:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+# Content hash of row, as it will be written to DB
+def row_hash(row):
+    raw = json.dumps(row, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.md5(raw.encode()).hexdigest()
+
+
+# In-memory cache of row hashes: {(table name, UserID): {natural key: hash}}.
+# Writer fills it from RowHashes table on first use and keeps it in sync,
+# so unchanged rows are detected without asking MySQL.
+class RowHashCache:
+    def __init__(self):
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    # Known hashes for table and user, or None if they're not loaded yet
+    def get(self, table_name, user_id):
+        with self.lock:
+            return self.hashes.get((table_name, user_id))
+
+    def put(self, table_name, user_id, hashes):
+        with self.lock:
+            self.hashes[(table_name, user_id)] = hashes
+
+    def update(self, table_name, user_id, hashes):
+        with self.lock:
+            self.hashes.setdefault((table_name, user_id), {}).update(hashes)
+
+    def clear(self):
+        with self.lock:
+            self.hashes.clear()
+
+
+# Default instance, shared by all writers of the process
+shared_hashes = RowHashCache()
+
+
+# Page without duplicates by natural key (fields of names): of rows with
+# the same key the one with the latest version field (lastChangeDate) is
+# kept, or the last one if there is no version. Returns [(key, row)] in
+# order of rows, key is None for rows without full key (they're all kept,
+# unique index doesn't apply to them)
+def latest_rows(rows, names, version=None):
+    best = {}
+    for i, row in enumerate(rows):
+        key = tuple(map(row.get, names))
+        if None in key:
+            # real keys never contain None, so this never equals one
+            best[(None, i)] = i
+            continue
+        current = best.get(key)
+        if (current is None or version is None
+                or (row.get(version) or '') >= (rows[current].get(version) or '')):
+            best[key] = i
+    return [(None if None in key else key, rows[i]) for key, i in sorted(best.items(), key=lambda item: item[1])]
+
+
+# Natural keys of rows written by this process and their versions:
+# {(table name, UserID, key): version}. Overlapping windows of API (stats
+# asked from the last lastChangeDate, financial report re-asked for days
+# already loaded) send the same rows again and again; rows written already
+# with the same or newer version are dropped before writing. Bounded LRU,
+# not Bloom filter: false positive of filter would drop row never written.
+class WrittenKeys:
+    def __init__(self, size=200000):
+        self.size = size
+        self.keys = OrderedDict()
+        # rows dropped as duplicates inside page and as written already
+        self.stats = {'duplicates': 0, 'written': 0}
+        self.lock = threading.Lock()
+
+    # Keys of {key: version} written already with the same or newer version
+    def written(self, table_name, user_id, items):
+        result = set()
+        with self.lock:
+            for key, version in items.items():
+                full_key = (table_name, user_id, key)
+                if full_key not in self.keys:
+                    continue
+                known = self.keys[full_key]
+                self.keys.move_to_end(full_key)
+                if version is None or (known is not None and known >= version):
+                    result.add(key)
+        return result
+
+    # Remember keys after their rows are written
+    def add(self, table_name, user_id, items):
+        with self.lock:
+            for key, version in items.items():
+                full_key = (table_name, user_id, key)
+                self.keys[full_key] = version
+                self.keys.move_to_end(full_key)
+            while len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+
+    def count(self, counter, number):
+        with self.lock:
+            self.stats[counter] += number
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+# Default instance, shared by all writers of the process
+shared_written = WrittenKeys()
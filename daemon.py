@@ -1,6 +1,151 @@
 import db_conn
+import http_pool
+import rate_limit
+import retries
+import change_cache
+import write_queue
+import fair_scheduler
+import leases
+import wb_api
 import json
-from concurrent.futures import ThreadPoolExecutor
+import sys
+import asyncio
+
+# Bounded queue with DB writer threads between fetching and writing,
+# if configured; otherwise every writer writes its pages itself
+def start_write_queue(config):
+    if 'write_queue' not in config:
+        return None
+    writes = write_queue.WriteQueue(**config['write_queue'])
+    writes.start()
+    return writes
+
+
+# Poller of warehouse reports for all writers, if configured; otherwise
+# every writer polls its report itself
+def start_report_poller(config):
+    if 'report_poller' not in config:
+        return None
+    import report_poller
+    reports = report_poller.ReportPoller(**config['report_poller'])
+    reports.start()
+    return reports
+
+
+def stop_report_poller(reports):
+    if reports is not None:
+        reports.stop()
+        print(f'Report poller: {reports.stats}')
+
+
+def stop_write_queue(writes):
+    if writes is not None:
+        writes.close()
+        print(f'Write queue: {writes.snapshot()}')
+
+
+# Show how much traffic went to every host and how many connections were opened
+def close_sessions(sessions):
+    for host, stats in sessions.connection_stats().items():
+        print(f'{host}: {stats}')
+    sessions.close()
+
+
+# Run writers of api_keys through fair scheduler (see fair_scheduler.py)
+# instead of thread per writer. on_finish(obj) is called when all
+# endpoints of key are done
+def run_scheduled(api_keys, config, sessions, writes, reports, on_finish):
+    scheduler_config = dict(config.get('scheduler', {}))
+    # Every running endpoint holds pooled connection, so leave connections
+    # for DB writers, or they'd wait for pool while fetchers wait for them
+    # on full queue
+    max_connections = config.get('db_pool', {}).get('max_connections', 20)
+    if writes is not None and max_connections and 'workers' not in scheduler_config:
+        scheduler_config['workers'] = max(1, max_connections - writes.writers)
+    scheduler = fair_scheduler.FairScheduler(**scheduler_config)
+
+    for obj in api_keys:
+        writer = db_conn.Writer(obj.api_key, obj.user_id, obj.runs, sessions,
+                                config.get('write_mode', 'replace'), writes, reports)
+        scheduler.add(writer, on_finish=lambda writer, obj=obj: on_finish(obj))
+    scheduler.run()
+    print(f'Scheduler: {scheduler.stats}')
+
+
+def run_threaded(api_keys, config):
+    # Keep-alive HTTP sessions, shared by all writers
+    sessions = http_pool.HostSessions(**config.get('http', {}))
+    writes = start_write_queue(config)
+    reports = start_report_poller(config)
+
+    # 'runs' is increased for every key right after its run
+    run_scheduled(api_keys, config, sessions, writes, reports, lambda obj: db_conn.count_run(obj.key_id))
+
+    stop_report_poller(reports)
+    stop_write_queue(writes)
+    close_sessions(sessions)
+
+
+# Sharded mode (daemon.py --shard): start as many such processes as needed,
+# on any hosts. Every process claims batches of free keys through KeyLeases
+# (see leases.py) until there are no free keys left in this cycle
+def run_sharded(config):
+    sessions = http_pool.HostSessions(**config.get('http', {}))
+    writes = start_write_queue(config)
+    reports = start_report_poller(config)
+    lease_manager = leases.LeaseManager(**config.get('shard', {}))
+    lease_manager.start()
+
+    def on_finish(obj):
+        try:
+            db_conn.count_run(obj.key_id)
+        finally:
+            lease_manager.release(obj.key_id)
+
+    while True:
+        with db_conn.mysql_db.connection_context():
+            api_keys = {obj.key_id: obj for obj in db_conn.APIKeys.select()}
+        claimed = lease_manager.claim(list(api_keys))
+        if not claimed:
+            break
+        print(f'{lease_manager.owner} claimed {len(claimed)} keys')
+        run_scheduled([api_keys[key_id] for key_id in claimed], config, sessions, writes, reports, on_finish)
+
+    lease_manager.stop()
+    stop_report_poller(reports)
+    stop_write_queue(writes)
+    close_sessions(sessions)
+
+
+# Resident mode (daemon.py --serve): run until SIGTERM / SIGINT, updating
+# every key on its own schedule, see service.py
+def serve(config):
+    import service
+    sessions = http_pool.HostSessions(**config.get('http', {}))
+    writes = start_write_queue(config)
+    reports = start_report_poller(config)
+
+    service_config = dict(config.get('service', {}))
+    # Running writer holds pooled connection for every endpoint it fetches
+    # at once (see Writer.run), so leave connections for DB writers and for
+    # service itself (APIKeys, runs), or writers would wait for pool while
+    # fetchers wait for them on full queue
+    max_connections = config.get('db_pool', {}).get('max_connections', 20)
+    if max_connections:
+        reserved = 1 + (writes.writers if writes is not None else 0)
+        limit = max(1, (max_connections - reserved) // db_conn.Writer.endpoint_workers)
+        workers = service_config.get('workers', limit)
+        if workers > limit:
+            print(f'WARNING: {workers} service workers with {db_conn.Writer.endpoint_workers} endpoints each '
+                  f'need more than {max_connections} DB connections, using {limit} workers')
+        service_config['workers'] = min(workers, limit)
+
+    service.Service(sessions, writes, reports, config.get('write_mode', 'replace'), **service_config).run()
+
+    stop_report_poller(reports)
+    stop_write_queue(writes)
+    close_sessions(sessions)
+
 
 def main():
     config_filename = 'config.json'
@@ -8,30 +153,71 @@ def main():
         config = json.load(config_file)
 
     # Initialize the MySQL database connection
+    # (local_infile is needed for bulk loading of big pages)
+    bulk_threshold = config.get('bulk_threshold')
     db_conn.mysql_db.init(
         config['database'],
         user=config['user'],
         password=config['password'],
         host=config['host'],
-        port=config['port']
+        port=config['port'],
+        local_infile=bulk_threshold is not None,
+        # pool: max_connections, stale_timeout, timeout (to wait for free connection)
+        **config.get('db_pool', {})
     )
+    db_conn.Writer.bulk_threshold = bulk_threshold
+    # pages of financial report are bulk loaded only if they're at least
+    # bulk_threshold rows, so they're never split smaller than that
+    json_chunk = config.get('json_chunk', wb_api.WBApiConn.json_chunk)
+    if bulk_threshold is not None:
+        json_chunk = max(json_chunk, bulk_threshold)
+    wb_api.WBApiConn.json_chunk = json_chunk
+    db_conn.Writer.endpoint_workers = config.get('endpoint_workers', 1)
+    db_conn.Writer.columnar = config.get('columnar', False)
+    # how many natural keys of written rows are kept to drop repeated rows
+    change_cache.shared_written.size = config.get('written_keys', 200000)
 
-    # Get APIKeys from the database
-    api_keys = list(db_conn.APIKeys.select())
-    instances = []
-    for obj in api_keys:
-        instances.append(db_conn.Writer(obj.api_key, obj.user_id, obj.runs))
+    # Override default API rate limits, if needed
+    rate_limit.shared_limiter.set_limits(config.get('rate_limits', {}))
+    retries.shared_policy.configure(**config.get('retry', {}))
+
+    # Create or migrate tables once, before writers start
+    with db_conn.mysql_db.connection_context():
+        db_conn.ensure_schema()
+
+    if '--serve' in sys.argv[1:]:
+        # 'runs' of every key is updated by service after each its run
+        serve(config)
+        print(f'MySQL pool: {db_conn.mysql_db.pool_stats}')
+        db_conn.mysql_db.close_all()
+        return
+
+    if '--shard' in sys.argv[1:]:
+        # keys are claimed through KeyLeases, see run_sharded
+        run_sharded(config)
+    else:
+        # Get APIKeys from the database
+        with db_conn.mysql_db.connection_context():
+            api_keys = list(db_conn.APIKeys.select())
 
-    # Start the threads
-    with ThreadPoolExecutor() as executor:
-        for instance in instances:
-            executor.submit(instance.run)
+        if config.get('async', False):
+            # One event loop for all keys instead of thread per key
+            import async_writer
+            asyncio.run(async_writer.run_writers(api_keys, config.get('async_concurrency', 1000),
+                                                 config.get('http', {}), config.get('write_mode', 'replace')))
+        else:
+            run_threaded(api_keys, config)
 
-    # Wait for the threads to finish
-    executor.shutdown()
+    # Show how often API calls were retried or given up
+    for group, stats in retries.shared_stats.snapshot().items():
+        print(f'{group}: {stats}')
+    # and how many repeated rows were not written
+    print(f'Dropped rows: {change_cache.shared_written.snapshot()}')
 
-    # Update in APIKeys 'runs' field with += 1
-    db_conn.APIKeys.update(runs=db_conn.APIKeys.runs + 1).execute()
+    # Show how DB connection pool was used
+    # ('runs' of APIKeys is updated for every key after its run)
+    print(f'MySQL pool: {db_conn.mysql_db.pool_stats}')
+    db_conn.mysql_db.close_all()
 
 
 if __name__ == '__main__':
@@ -1,9 +1,52 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from itertools import chain
+from time import monotonic
+from datetime import datetime
 from peewee import *
 from playhouse.mysql_ext import JSONField
+from playhouse.pool import PooledMySQLDatabase, MaxConnectionsExceeded
 from wb_api import WBApiConn
-
-# Establish a single database connection
-mysql_db = MySQLDatabase(None)
+from change_cache import row_hash, shared_hashes, latest_rows, shared_written
+from projector import projector_for
+from bulk_load import bulk_load, LOCAL_INFILE_DISABLED
+import batching
+import columnar
+import schema
+
+# MySQL connection pool with usage metrics.
+# Every task (Writer.run or its endpoint, page write of AsyncWriter) checks out connection
+# explicitly with connection_context() and returns it to pool at the end,
+# so N workers hold at most N connections and none of them leaks
+class MeteredMySQLDatabase(PooledMySQLDatabase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_stats = {'checkouts': 0, 'waits': 0, 'peak_in_use': 0}
+        self._stats_lock = threading.Lock()
+        self._waiting = threading.local()
+
+    def _connect(self):
+        try:
+            conn = super()._connect()
+        except MaxConnectionsExceeded:
+            # pool is exhausted, connect() will wait for free connection;
+            # count every waiting caller once
+            if not getattr(self._waiting, 'flag', False):
+                self._waiting.flag = True
+                with self._stats_lock:
+                    self.pool_stats['waits'] += 1
+            raise
+
+        self._waiting.flag = False
+        with self._stats_lock:
+            self.pool_stats['checkouts'] += 1
+            self.pool_stats['peak_in_use'] = max(self.pool_stats['peak_in_use'], len(self._in_use))
+        return conn
+
+
+# Single database shared by all writers, configured in daemon
+mysql_db = MeteredMySQLDatabase(None)
 
 class BaseModel(Model):
     class Meta:
@@ -285,9 +328,9 @@ class ProductPromos(BaseModel):
 
     class Meta:
         table_name = "ProductPromos"
-        # make combo (advertId, nmId, date, appType, userID) unique
+        # make combo (advertId, nmId, date, appType, UserID) unique
         indexes = (
-            (('advertId', 'nmId', 'date', 'appType', 'userID'), True),
+            (('advertId', 'nmId', 'date', 'appType', 'UserID'), True),
         )
 
 
@@ -327,127 +370,625 @@ class APIKeys(BaseModel):
         table_name = "APIKeys"
 
 
-class Writer:
-    def __init__(self, token, user_id, run_number=0):
-        self.conn = WBApiConn(token)
-        self.user_id = user_id
-        self.run_number = run_number
-        # APIKeys should not be managed by Python, so it's not in tables_list
-        self.tables_list = [ProductCards, ProductPrices, OrdersStats, SalesStats, WarehousesReport,
-                            FinancialReport, ProductAdverts, ProductPromos, PromoCalendar]
-        # mysql_db.connect() not needed, idk why but it's already connected
+# Leases of API keys in sharded mode: worker process owns key until
+# expiresAt and prolongs it by heartbeat; finishedAt is end of the last run
+class KeyLeases(BaseModel):
+    key_id = IntegerField(primary_key=True)  # APIKeys.key_id
+    owner = CharField(max_length=128, null=True)
+    expiresAt = DateTimeField(null=True)
+    finishedAt = DateTimeField(null=True)
 
-    def multi_insert(self, table, data_array):
-        # By default, 'insert_many' method gives exception if in dict
-        # there are keys that are not in table fields, so on every API update
-        # we need to check if there are new fields in response and update code.
-        # To avoid it, we'll create own method for inserting data, inserting
-        # only fileds, presented in table.
+    class Meta:
+        table_name = "KeyLeases"
 
-        limit = 5000 # on more, especially for long rows about 1 KB, remote MySQL becomes buggy
 
-        # remove all service fields
-        fields = [field for field in list(table.__dict__.keys()) if field[0] != '_']
-        fields.remove('DoesNotExist')
+# Increase 'runs' of API key after its run is finished
+def count_run(key_id):
+    with mysql_db.connection_context():
+        APIKeys.update(runs=APIKeys.runs + 1).where(APIKeys.key_id == key_id).execute()
 
-        # iterate array, for each element create dict with only fields
-        result = []
-        for data in data_array:
-            data_dict = {key: data[key] for key in fields if key in data}
-            # also automatically add APIKeyID :)
-            data_dict['UserID'] = self.user_id
-            result.append(data_dict)
 
-        # we still should use 'insert_many' to avoid performance issues
-        # due to our DB may be remote. also use atomic
-        with mysql_db.atomic():
-            for batch in chunked(result, limit):
-                table.insert_many(batch).on_conflict_replace().execute()
+# Watermarks of incremental sync: last seen cursor / lastChangeDate / rrd_id
+# for every (UserID, table), so each run asks API only for what changed
+class SyncState(BaseModel):
+    auto_id = IntegerField(primary_key=True)  # default auto_increment
+    tableName = CharField(max_length=64)
+    cursor = JSONField(null=True)
+    updatedAt = DateTimeField(null=True)
+    UserID = CharField(max_length=36)
 
-    def init_tables(self):
-        mysql_db.create_tables(self.tables_list)
+    class Meta:
+        table_name = "SyncState"
+        indexes = (
+            (('tableName', 'UserID'), True),
+        )
 
-    def update_data(self):
-        print("Updating data...")
 
-        # each 30 minutes
-        print('Getting cards...')
-        try:
-            data = self.conn.get_product_cards()
-            self.multi_insert(ProductCards, data)
-        except Exception as e:
-            print(f'Error while getting cards: {e}, skipping...')
+# Content hashes of rows already written, see Writer.changed_rows()
+class RowHashes(BaseModel):
+    auto_id = IntegerField(primary_key=True)  # default auto_increment
+    tableName = CharField(max_length=64)
+    rowKey = CharField(max_length=255)
+    hash = CharField(max_length=32)
+    UserID = CharField(max_length=36)
 
-        print('Getting prices...')
-        try:
-            data = self.conn.get_product_prices()
-            self.multi_insert(ProductPrices, data)
-        except Exception as e:
-            print(f'Error while getting prices: {e}, skipping...')
+    class Meta:
+        table_name = "RowHashes"
+        indexes = (
+            (('tableName', 'rowKey', 'UserID'), True),
+        )
 
-        print('Getting orders stats...')
-        # don't remove previous for dynamic stats
-        try:
-            data = self.conn.get_stats('orders', first_use=(self.run_number == 0))
-            self.multi_insert(OrdersStats, data)
-        except Exception as e:
-            print(f'Error while getting orders stats: {e}, skipping...')
 
-        print('Getting sales stats...')
-        try:
-            data = self.conn.get_stats('sales', first_use=(self.run_number == 0))
-            self.multi_insert(SalesStats, data)
-        except Exception as e:
-            print(f'Error while getting sales stats: {e}, skipping...')
+# Finished chunks of history loads (see WBApiConn.backfill_chunks), so
+# interrupted load continues after restart
+class BackfillChunks(BaseModel):
+    auto_id = IntegerField(primary_key=True)  # default auto_increment
+    tableName = CharField(max_length=64)
+    chunk = CharField(max_length=64)
+    doneAt = DateTimeField(null=True)
+    UserID = CharField(max_length=36, null=True)
 
-        print('Getting warehouses report...')
-        try:
-            data = self.conn.get_warehouses_report()
-            self.multi_insert(WarehousesReport, data)
-        except Exception as e:
-            print(f'Error while getting warehouses report: {e}, skipping...')
+    class Meta:
+        table_name = "BackfillChunks"
+        indexes = (
+            (('tableName', 'chunk', 'UserID'), True),
+        )
+
+
+# Fingerprint of models the DB schema was migrated to, see schema.py
+class SchemaVersion(BaseModel):
+    auto_id = IntegerField(primary_key=True)  # default auto_increment
+    version = CharField(max_length=32)
+    updatedAt = DateTimeField(null=True)
+
+    class Meta:
+        table_name = "SchemaVersion"
+
+
+# Tables managed by Python; APIKeys should not be managed by Python, so it's
+# not here
+TABLES = [ProductCards, ProductPrices, OrdersStats, SalesStats, WarehousesReport,
+          FinancialReport, ProductAdverts, ProductPromos, PromoCalendar, SyncState,
+          RowHashes, SchemaVersion, KeyLeases, BackfillChunks]
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+# Create missing tables and columns once per process: the first caller
+# compares models with stored schema version and migrates if they differ,
+# others return at once, so there's no DDL on the path of every user
+def ensure_schema(models=TABLES):
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        version = schema.schema_version(models)
+        if SchemaVersion.table_exists():
+            stored = SchemaVersion.select(SchemaVersion.version).order_by(SchemaVersion.auto_id.desc()).first()
+            if stored is not None and stored.version == version:
+                _schema_ready = True
+                return
+        print('Checking DB schema...')
+        if schema.migrate_tables(mysql_db, models):
+            SchemaVersion.insert(version=version, updatedAt=datetime.now()).execute()
+        _schema_ready = True
+
+
+# Tables synced incrementally and their watermark keys in WBApiConn.watermarks
+WATERMARKS = {
+    ProductCards: 'cards',
+    OrdersStats: 'orders',
+    SalesStats: 'sales',
+    FinancialReport: 'finance',
+    ProductPromos: 'promos',
+}
+
+# Tables whose fetch continues where previous one gave up and their keys in
+# WBApiConn.resume; the place is saved in SyncState as '<table>:resume'
+RESUMED = {
+    ProductCards: 'cards',
+    ProductPrices: 'prices',
+    FinancialReport: 'finance',
+}
+
+
+# Tables loaded in chunks on first use and their keys in WBApiConn.backfill_chunks
+BACKFILLS = {
+    FinancialReport: 'finance',
+    ProductPromos: 'promos',
+}
+# Tables with finished chunks in WBApiConn.backfill_chunks: history loads and
+# ended promotions of calendar, which are not fetched again
+CHUNKED = {**BACKFILLS, PromoCalendar: 'calendar'}
+
+
+# Tables where rows are mostly the same from run to run, so unchanged ones
+# are detected by content hash and not written again. Not ProductPromos:
+# it's fetched only from its watermark, so rows are mostly new and hashes
+# of every advert-day would only grow
+CHANGE_TRACKED = {ProductCards, ProductPrices, ProductAdverts, PromoCalendar}
+
+
+# Wide uniform tables, pages of them go through columnar transform (see
+# columnar.py) if Writer.columnar is set
+COLUMNAR = {FinancialReport, OrdersStats, SalesStats}
+
+
+# Tables re-fetched by overlapping windows: duplicates by natural key and
+# rows written already in this process are dropped, see Writer.fresh_rows
+DEDUPED = {FinancialReport, OrdersStats, SalesStats}
+
+
+# Endpoints updated once a day, others are updated every 30 minutes
+DAILY = {'financial report', 'promos stats'}
+
+
+# Fields of table's unique index without UserID, i.e. natural key of row
+def natural_key(table):
+    for fields, unique in table._meta.indexes:
+        if unique:
+            return [field for field in fields if field.lower() != 'userid']
+    return []
+
+
+# Rows of one page prepared for writing. done is set when the rows are
+# written (or writing failed, then error is set)
+class WriteJob:
+    def __init__(self, table, rows, hashes, user_id, mode, keys=None):
+        self.table = table
+        self.rows = rows
+        self.hashes = hashes
+        self.user_id = user_id
+        self.mode = mode
+        # {natural key: version} of rows, remembered in shared_written
+        # after they're written
+        self.keys = keys or {}
+        self.done = threading.Event()
+        self.error = None
+
+
+# Write jobs of the same table and mode in one transaction. Projected rows
+# already have UserID in them, so pages of different users are merged into
+# the same statements
+def write_jobs(jobs):
+    table, mode = jobs[0].table, jobs[0].mode
+    projector = projector_for(table)
+    pages = [job.rows for job in jobs]
+
+    # we still should insert many rows at once to avoid performance issues
+    # due to our DB may be remote. also use atomic
+    with mysql_db.atomic():
+        if not bulk_insert(projector, pages, mode):
+            insert_batches(projector, list(chain.from_iterable(pages)), mode)
+        for job in jobs:
+            save_hashes(table, job.hashes, job.user_id)
+    for job in jobs:
+        shared_hashes.update(table._meta.table_name, job.user_id, job.hashes)
+        shared_written.add(table._meta.table_name, job.user_id, job.keys)
+
+
+# Insert rows in batches sized by bytes, not by rows count: too big
+# statements make remote MySQL buggy (or exceed max_allowed_packet),
+# while small ones waste round trips on narrow rows
+def insert_batches(projector, rows, mode):
+    batching.init_max_packet(mysql_db)
+    batcher = batching.batcher_for(projector.model)
+    for batch, size in batcher.batches(rows):
+        start = monotonic()
+        insert_rows(projector, batch, mode)
+        batcher.record(size, monotonic() - start)
+
+
+# Insert projected rows with one multi-row statement
+def insert_rows(projector, rows, mode):
+    sql = projector.insert_sql(mysql_db, mode, len(rows))
+    mysql_db.execute_sql(sql, list(chain.from_iterable(rows)))
+
+
+# Write big pages with bulk load. Returns False if rows should be inserted
+# usual way: pages are small or bulk load is not allowed by server
+def bulk_insert(projector, pages, mode):
+    if Writer.bulk_threshold is None or sum(map(len, pages)) < Writer.bulk_threshold:
+        return False
+    try:
+        bulk_load(mysql_db, projector, pages, mode)
+    except (OperationalError, InternalError) as e:
+        if not e.args or e.args[0] not in LOCAL_INFILE_DISABLED:
+            raise
+        print(f'WARNING: LOAD DATA LOCAL INFILE is disabled ({e}), bulk loading is turned off')
+        Writer.bulk_threshold = None
+        return False
+    return True
+
+
+def save_hashes(table, hashes, user_id):
+    data = [{'tableName': table._meta.table_name, 'rowKey': key, 'hash': digest}
+            for key, digest in hashes.items()]
+    projector = projector_for(RowHashes)
+    insert_batches(projector, projector.project(data, user_id), 'replace')
+
+
+class Writer:
+    # pages with at least this many rows are written with LOAD DATA LOCAL
+    # INFILE through staging table (see bulk_load.py), None to disable
+    bulk_threshold = None
+    # how many endpoints of one user are fetched at once, 1 for one by one
+    endpoint_workers = 1
+    # transform pages of COLUMNAR tables column by column
+    columnar = False
+
+    def __init__(self, token, user_id, run_number=0, sessions=None, write_mode='replace',
+                 write_queue=None, reports=None):
+        self.conn = WBApiConn(token, sessions)
+        self.user_id = user_id
+        self.run_number = run_number
+        # 'replace' (REPLACE INTO, delete + insert) or 'upsert'
+        # (INSERT ... ON DUPLICATE KEY UPDATE, keeps auto_id of existing rows)
+        self.write_mode = write_mode
+        # WriteQueue shared with other writers (see write_queue.py), or None
+        # to write pages in this thread
+        self.write_queue = write_queue
+        # ReportPoller generating warehouse reports in background (see
+        # report_poller.py), or None to poll in writer's thread
+        self.reports = reports
+        self.report = None
+        self.tables_list = TABLES
+        # tables are created and watermarks loaded on first run()
+        self.loaded = False
+        self.load_lock = threading.Lock()
+        # keys of WBApiConn.resume saved in SyncState
+        self.stored_resume = set()
+        # connection is taken from pool for the whole run() or, if endpoints
+        # are fetched in parallel, for every endpoint; see MeteredMySQLDatabase
+
+    def multi_insert(self, table, data_array):
+        job = self.prepare(table, data_array)
+        if job is not None:
+            write_jobs([job])
 
+    # Project page of API rows and drop unchanged ones, without touching
+    # written data. Returns WriteJob, or None if there is nothing to write
+    def prepare(self, table, data_array):
+        # By default, 'insert_many' method gives exception if in dict
+        # there are keys that are not in table fields, so on every API update
+        # we need to check if there are new fields in response and update code.
+        # To avoid it, rows are projected to table fields only (see projector.py),
+        # projector for each table is built once and then reused.
+
+        keys = {}
+        if table in DEDUPED:
+            data_array, keys = self.fresh_rows(table, data_array)
+
+        projector = projector_for(table)
+        if Writer.columnar and table in COLUMNAR:
+            result = columnar.transform(projector, data_array, self.user_id)
+        else:
+            result = projector.project(data_array, self.user_id)
+
+        # skip rows that are the same as already written ones
+        hashes = {}
+        if table in CHANGE_TRACKED:
+            result, hashes = self.changed_rows(table, projector, result)
+        if not result:
+            return None
+        return WriteJob(table, result, hashes, self.user_id, self.write_mode, keys)
+
+    # Drop duplicates inside page (the latest lastChangeDate wins) and rows
+    # written already with the same or newer lastChangeDate, so they don't
+    # cost REPLACE (delete + insert) again. Returns rows and
+    # {natural key: version} of them
+    def fresh_rows(self, table, data_array):
+        version = 'lastChangeDate' if 'lastChangeDate' in table._meta.fields else None
+        pairs = latest_rows(data_array, natural_key(table), version)
+        shared_written.count('duplicates', len(data_array) - len(pairs))
+
+        keys = {key: row.get(version) if version else None for key, row in pairs if key is not None}
+        written = shared_written.written(table._meta.table_name, self.user_id, keys)
+        if written:
+            shared_written.count('written', len(written))
+            pairs = [(key, row) for key, row in pairs if key not in written]
+            keys = {key: keys[key] for key, row in pairs if key is not None}
+        return [row for key, row in pairs], keys
+
+    # Write page now, or hand it to DB writers if there is write queue.
+    # Returns WriteJob to wait for, or None if page had nothing to write
+    def submit(self, table, data_array):
+        job = self.prepare(table, data_array)
+        if job is None:
+            return None
+        if self.write_queue is None:
+            write_jobs([job])
+            job.done.set()
+        else:
+            self.write_queue.put(job)
+        return job
+
+    # Filter out rows with the same content hash as written before.
+    # Returns changed rows and {natural key: hash} of them
+    def changed_rows(self, table, projector, rows):
+        table_name = table._meta.table_name
+        known = shared_hashes.get(table_name, self.user_id)
+        if known is None:
+            query = (RowHashes.select(RowHashes.rowKey, RowHashes.hash)
+                     .where((RowHashes.tableName == table_name) & (RowHashes.UserID == self.user_id)))
+            known = {row.rowKey: row.hash for row in query}
+            shared_hashes.put(table_name, self.user_id, known)
+
+        key_indexes = [projector.index(field) for field in natural_key(table)]
+        result, hashes = [], {}
+        for row in rows:
+            key = '|'.join(str(row[i]) for i in key_indexes)
+            digest = row_hash(row)
+            if known.get(key) != digest:
+                result.append(row)
+                hashes[key] = digest
+        return result, hashes
+
+    # No-op after the first call in process, see ensure_schema
+    def init_tables(self):
+        ensure_schema(self.tables_list)
+
+    # Give connector watermarks saved on previous runs
+    def load_watermarks(self):
+        keys = {table._meta.table_name: key for table, key in WATERMARKS.items()}
+        resumed = {f'{table._meta.table_name}:resume': key for table, key in RESUMED.items()}
+        for state in SyncState.select().where(SyncState.UserID == self.user_id):
+            if state.tableName in keys:
+                self.conn.watermarks[keys[state.tableName]] = state.cursor
+            elif state.tableName in resumed:
+                self.conn.resume[resumed[state.tableName]] = state.cursor
+                self.stored_resume.add(resumed[state.tableName])
+        if 'promos' not in self.conn.watermarks:
+            self.conn.watermarks['promos'] = self.stored_promo_dates()
+
+    # Last date of every advert in ProductPromos, for the first run without
+    # 'promos' watermark: {advertId: 'YYYY-MM-DD'}
+    def stored_promo_dates(self):
+        query = (ProductPromos.select(ProductPromos.advertId, fn.MAX(ProductPromos.date).alias('last'))
+                 .where(ProductPromos.UserID == self.user_id).group_by(ProductPromos.advertId))
+        return {str(row.advertId): str(row.last)[:10] for row in query if row.last is not None}
+
+    def load_backfill_chunks(self):
+        keys = {table._meta.table_name: key for table, key in CHUNKED.items()}
+        for state in BackfillChunks.select().where(BackfillChunks.UserID == self.user_id):
+            if state.tableName in keys:
+                self.conn.backfill_chunks.setdefault(keys[state.tableName], set()).add(state.chunk)
+
+    # Whether data of key (of WBApiConn.watermarks and backfill_chunks) was
+    # never loaded for this user: key has no runs yet and no saved progress.
+    # Keys run before SyncState and BackfillChunks existed have runs but no
+    # progress, they aren't loaded from scratch. In service mode run of key
+    # is counted after all its endpoints ran once. Known only after load()
+    def first_use(self, key):
+        return self.run_number == 0 and not self.conn.watermarks.get(key) and not self.conn.backfill_chunks.get(key)
+
+    # Whether some history load of this writer is not finished yet
+    def backfilling(self):
+        return any(self.conn.backfilling(key, self.first_use(key)) for key in BACKFILLS.values())
+
+    # Save watermark and finished history chunks of table, called when
+    # all its rows fetched so far are written
+    def commit_progress(self, table):
+        self.commit_watermark(table)
+        self.commit_chunks(table)
+        self.commit_resume(table)
+
+    # Write (or queue) every page as soon as it arrives, saving progress
+    # after pages already written. Returns WriteJobs of pages
+    def write_pages(self, table, pages):
+        jobs = []
+        for data in pages:
+            job = self.submit(table, data)
+            if job is not None:
+                jobs.append(job)
+            self.checkpoint(table, jobs)
+        return jobs
+
+    # Save progress of table after every page, if the page is written
+    # already (so checkpoints never get ahead of data). Failed page stays in
+    # jobs, so after it progress of table isn't saved till the end of run
+    def checkpoint(self, table, jobs):
+        if all(job.done.is_set() and job.error is None for job in jobs):
+            self.commit_progress(table)
+
+    # Forget progress of table which wasn't written, so it's not saved by
+    # some later run; next run asks the same data again
+    def discard_progress(self, table):
+        self.conn.next_watermarks.pop(WATERMARKS.get(table), None)
+        self.conn.next_chunks.pop(CHUNKED.get(table), None)
+        self.conn.resume.pop(RESUMED.get(table), None)
+
+    def commit_chunks(self, table):
+        key = CHUNKED.get(table)
+        if key not in self.conn.next_chunks:
+            return
+        chunks = self.conn.next_chunks.pop(key)
+        data = [{'tableName': table._meta.table_name, 'chunk': chunk, 'doneAt': datetime.now()}
+                for chunk in chunks]
+        projector = projector_for(BackfillChunks)
+        insert_batches(projector, projector.project(data, self.user_id), 'replace')
+        self.conn.backfill_chunks.setdefault(key, set()).update(chunks)
+
+    # Save watermark of table after its rows are written, so rows are never
+    # skipped if writing fails
+    def commit_watermark(self, table):
+        key = WATERMARKS.get(table)
+        if key not in self.conn.next_watermarks:
+            return
+        cursor = self.conn.next_watermarks.pop(key)
+        SyncState.insert(tableName=table._meta.table_name, cursor=cursor,
+                         updatedAt=datetime.now(), UserID=self.user_id).on_conflict_replace().execute()
+        self.conn.watermarks[key] = cursor
+
+    # Save place where fetch of table gave up (flows take it from
+    # WBApiConn.resume when they start), so the next run continues from
+    # there even in a new process; forget it once fetch went further
+    def commit_resume(self, table):
+        key = RESUMED.get(table)
+        table_name = f'{table._meta.table_name}:resume'
+        if key in self.conn.resume:
+            SyncState.insert(tableName=table_name, cursor=self.conn.resume[key],
+                             updatedAt=datetime.now(), UserID=self.user_id).on_conflict_replace().execute()
+            self.stored_resume.add(key)
+        elif key in self.stored_resume:
+            SyncState.delete().where((SyncState.tableName == table_name) &
+                                     (SyncState.UserID == self.user_id)).execute()
+            self.stored_resume.discard(key)
+
+    # List of all (name, table, fetch, after), in order.
+    # fetch is called without arguments and returns iterator over pages of
+    # rows for the table (async one, if self.conn is asyncio connector).
+    # after is names of endpoints that must be finished before this one;
+    # every dependency is earlier in the list.
+    # First use of endpoint is taken from state loaded by load()
+    def all_endpoints(self):
+        first_use = self.first_use
+
+        result = [
+            # each 30 minutes
+            ('cards', ProductCards, self.conn.iter_product_cards, ()),
+            ('prices', ProductPrices, self.conn.iter_product_prices, ()),
+            ('orders stats', OrdersStats, partial(self.conn.iter_stats, 'orders', first_use=first_use('orders')), ()),
+            ('sales stats', SalesStats, partial(self.conn.iter_stats, 'sales', first_use=first_use('sales')), ()),
+            ('warehouses report', WarehousesReport, self.iter_warehouses_report, ()),
+        ]
         # run every day
-        if self.run_number % (60 * 24 / 30) == 0:
-            print('Getting financial report...')
+        result.append(('financial report', FinancialReport,
+                       partial(self.conn.iter_financial_report, first_use=first_use('finance')), ()))
+        result.append(('product adverts', ProductAdverts,
+                       partial(self.conn.iter_adv_deatils, first_use=first_use('promos')), ()))
+        # run every day, must be after adverts (uses their IDs)
+        result.append(('promos stats', ProductPromos,
+                       partial(self.conn.iter_prom_stats, first_use=first_use('promos')), ('product adverts',)))
+        result.append(('promo calendar', PromoCalendar, self.conn.iter_promo_calendar, ()))
+        return result
+
+    # Start generation of warehouse report in background, if it's in names
+    # and there is report poller; callback is called when report is ready
+    def start_reports(self, names, callback=None):
+        if self.reports is not None and self.report is None and 'warehouses report' in names:
+            self.report = self.reports.submit(self.conn.token, callback)
+
+    # Whether endpoint may be fetched without waiting
+    def endpoint_ready(self, name):
+        return name != 'warehouses report' or self.report is None or self.report.ready.is_set()
+
+    # Pages of warehouse report: download of report started by start_reports
+    # (waits for it, if it's not ready yet) or usual polling in this thread
+    def iter_warehouses_report(self):
+        report, self.report = self.report, None
+        if report is None:
+            return self.conn.iter_warehouses_report()
+        report.ready.wait()
+        if report.status != 'done':
+            return iter(())
+        return self.conn.iter_warehouse_download(report.task_id)
+
+    # Endpoints to update on this run: names in due, or, if it's None,
+    # chosen by run number of cron run (each 30 minutes, daily ones on
+    # every 48th run)
+    def endpoints(self, due=None):
+        result = self.all_endpoints()
+        if due is None:
+            daily = self.run_number % (60 * 24 / 30) == 0
+            due = {name for name, table, fetch, after in result if daily or name not in DAILY}
+        return [endpoint for endpoint in result if endpoint[0] in due]
+
+    def update_data(self, due=None):
+        print("Updating data...")
+
+        if self.endpoint_workers > 1:
+            self.update_parallel(self.endpoints(due))
+            print('Done!')
+            return
+
+        # (name, table, jobs) of fetched endpoints, watermarks not saved yet
+        pending = []
+        for name, table, fetch, after in self.endpoints(due):
+            print(f'Getting {name}...')
             try:
-                data = self.conn.get_financial_report(first_use=(self.run_number == 0))
-                self.multi_insert(FinancialReport, data)
+                # write every page as soon as it arrives (or queue it, then
+                # the next endpoint is fetched while DB writers are busy)
+                jobs = self.write_pages(table, fetch())
+                pending.append((name, table, jobs))
             except Exception as e:
-                print(f'Error while getting financial report: {e}, skipping...')
+                print(f'Error while getting {name}: {e}, skipping...')
+            pending = self.commit_written(pending)
 
-        print('Getting product adverts...')
-        try:
-            data = self.conn.get_adv_deatils(first_use=(self.run_number == 0))
-            self.multi_insert(ProductAdverts, data)
-        except Exception as e:
-            print(f'Error while getting product adverts: {e}, skipping...')
+        self.commit_written(pending, wait=True)
+        print('Done!')
 
-        # run every day
-        if self.run_number % (60 * 24 / 30) == 0:
-            print('Getting promos stats...')
+    # Save watermarks of endpoints whose pages are all written. Returns
+    # endpoints still in write queue; with wait=True waits for all of them
+    def commit_written(self, pending, wait=False):
+        left = []
+        for name, table, jobs in pending:
+            if not wait and not all(job.done.is_set() for job in jobs):
+                left.append((name, table, jobs))
+                continue
+            for job in jobs:
+                job.done.wait()
+            errors = [job.error for job in jobs if job.error is not None]
+            if errors:
+                print(f'Error while writing {name}: {errors[0]}, skipping...')
+                self.discard_progress(table)
+                continue
             try:
-                data = self.conn.get_prom_stats(first_use=(self.run_number == 0))
-                self.multi_insert(ProductPromos, data)
+                self.commit_progress(table)
             except Exception as e:
-                print(f'Error while getting product promos: {e}, skipping...')
-
-        print('Getting promo calendar...')
+                print(f'Error while saving watermark of {name}: {e}, skipping...')
+        return left
+
+    # Endpoints hit different hosts with their own rate limits, so independent
+    # ones are fetched at once and run takes about as long as the slowest
+    # endpoint instead of the sum of them. Dependent endpoint waits for its
+    # dependencies (they're submitted earlier, so they're already running)
+    def update_parallel(self, endpoints):
+        futures = {}
+        with ThreadPoolExecutor(self.endpoint_workers) as executor:
+            for name, table, fetch, after in endpoints:
+                depends = [futures[dep] for dep in after if dep in futures]
+                futures[name] = executor.submit(self.update_endpoint, name, table, fetch, depends)
+
+    # Fetch and write one endpoint in its own thread, with its own connection
+    # (nothing reads its future, so every error is reported here)
+    def update_endpoint(self, name, table, fetch, depends=()):
         try:
-            data = self.conn.get_promo_calendar()
-            self.multi_insert(PromoCalendar, data)
+            wait(depends)
+            with mysql_db.connection_context():
+                print(f'Getting {name}...')
+                jobs = self.write_pages(table, fetch())
+                self.commit_written([(name, table, jobs)], wait=True)
         except Exception as e:
-            print(f'Error while getting promo calendar: {e}, skipping...')
-
-        print('Done!')
+            print(f'Error while getting {name}: {e}, skipping...')
 
     def delete_tables(self):
         mysql_db.drop_tables(self.tables_list)
 
-    def run(self):
-
-        self.init_tables()
-        self.update_data()
+    # Tables and watermarks are loaded only once and then kept in memory,
+    # even if writer is run many times (service mode)
+    def load(self):
+        with self.load_lock:
+            if not self.loaded:
+                with mysql_db.connection_context():
+                    self.init_tables()
+                    self.load_watermarks()
+                    self.load_backfill_chunks()
+                self.loaded = True
+
+    # Update endpoints named in due (see endpoints())
+    def run(self, due=None):
+        self.load()
+        endpoints = self.endpoints(due)
+        # report is generated while other endpoints are fetched
+        self.start_reports({endpoint[0] for endpoint in endpoints})
+        if self.endpoint_workers > 1:
+            # every endpoint takes connection for itself
+            self.update_data(due)
+        else:
+            with mysql_db.connection_context():
+                self.update_data(due)
 
 
 if __name__ == '__main__':
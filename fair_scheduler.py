@@ -0,0 +1,179 @@
+import threading
+from time import monotonic
+import db_conn
+
+# One endpoint of one writer. Pages are fetched in slices: the page iterator
+# (sans-IO flow of WBApiConn) is kept between slices, so endpoint may be
+# paused at page boundary and resumed later by any worker
+class Unit:
+    def __init__(self, writer, name, table, fetch, after, backfill):
+        self.writer = writer
+        self.name = name
+        self.table = table
+        self.fetch = fetch
+        self.after = after
+        self.backfill = backfill
+        self.pages = None
+        self.jobs = []
+        self.running = False
+
+
+# Runs endpoints of all writers on a fixed number of workers with weighted
+# fair queuing: every writer has virtual time, which grows by seconds its
+# units worked divided by writer's weight, and the next unit is taken from
+# writer with the smallest virtual time. So one big user doesn't hold
+# workers for hours while small ones wait.
+#  - writer loading history (first run or unfinished load) has low weight
+#    and lower priority: its units are taken only if there are no usual
+#    ones, and are paused after 'quantum' seconds if others are waiting
+#  - usual units are paused after 'quantum' seconds too, to let other
+#    writers in, so big ones go in turns
+#  - at most 'tenant_cap' units of one writer run at once
+#  - endpoint waits for endpoints it depends on (see Writer.all_endpoints)
+#    and for warehouse report generated in background (see report_poller.py)
+class FairScheduler:
+    def __init__(self, workers=8, tenant_cap=2, quantum=5.0, backfill_weight=0.25):
+        self.workers = workers
+        self.tenant_cap = tenant_cap
+        self.quantum = quantum
+        self.backfill_weight = backfill_weight
+
+        # units not finished yet
+        self.units = []
+        # per writer: weight, virtual time, number of running units,
+        # names of scheduled and finished endpoints
+        self.weights = {}
+        self.vtime = {}
+        self.running = {}
+        self.names = {}
+        self.finished = {}
+        # per writer: function called when all its units are finished
+        self.callbacks = {}
+        self.condition = threading.Condition()
+        self.stats = {'units': 0, 'slices': 0, 'preempted': 0}
+
+    def add(self, writer, weight=1, on_finish=None):
+        # backfill chunks are known only after load
+        try:
+            writer.load()
+        except Exception as e:
+            print(f'Error while loading state of {writer.user_id}: {e}')
+        backfill = writer.backfilling()
+        endpoints = writer.endpoints()
+        with self.condition:
+            for name, table, fetch, after in endpoints:
+                self.units.append(Unit(writer, name, table, fetch, after, backfill))
+            self.weights[writer] = weight * (self.backfill_weight if backfill else 1)
+            # new writer starts with the least virtual time of others, so it
+            # doesn't take workers for as long as others have worked already
+            self.vtime[writer] = min(self.vtime.values(), default=0)
+            self.running[writer] = 0
+            self.names[writer] = {endpoint[0] for endpoint in endpoints}
+            self.finished[writer] = set()
+            self.callbacks[writer] = on_finish
+            self.stats['units'] += len(endpoints)
+            self.condition.notify_all()
+        # reports of all writers are generated while others units run
+        writer.start_reports(self.names[writer], self.notify)
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def eligible(self, unit):
+        writer = unit.writer
+        return (not unit.running and self.running[writer] < self.tenant_cap
+                and all(name in self.finished[writer] for name in unit.after if name in self.names[writer])
+                and (unit.pages is not None or writer.endpoint_ready(unit.name)))
+
+    # Next unit to run, None if no unit may run now; called under lock
+    def pick(self):
+        best, best_key = None, None
+        for unit in self.units:
+            if not self.eligible(unit):
+                continue
+            key = (unit.backfill, self.vtime[unit.writer])
+            if best is None or key < best_key:
+                best, best_key = unit, key
+        return best
+
+    # Whether some other unit waits for worker
+    def contended(self):
+        with self.condition:
+            return self.pick() is not None
+
+    # Run all added units, returns when they're finished
+    def run(self):
+        threads = [threading.Thread(target=self.work, name=f'scheduler-{i}') for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def work(self):
+        while True:
+            with self.condition:
+                unit = self.pick()
+                while unit is None:
+                    if not self.units:
+                        return
+                    self.condition.wait()
+                    unit = self.pick()
+                unit.running = True
+                self.running[unit.writer] += 1
+
+            start = monotonic()
+            finished = self.run_slice(unit)
+            elapsed = monotonic() - start
+
+            callback = None
+            with self.condition:
+                writer = unit.writer
+                unit.running = False
+                self.running[writer] -= 1
+                self.vtime[writer] += elapsed / self.weights[writer]
+                self.stats['slices'] += 1
+                if finished:
+                    self.units.remove(unit)
+                    self.finished[writer].add(unit.name)
+                    if self.finished[writer] == self.names[writer]:
+                        callback = self.callbacks.pop(writer)
+                else:
+                    self.stats['preempted'] += 1
+                self.condition.notify_all()
+
+            if callback is not None:
+                try:
+                    callback(writer)
+                except Exception as e:
+                    print(f'Error after run of {writer.user_id}: {e}')
+
+    # Fetch and write pages of unit for about 'quantum' seconds. Returns
+    # True if unit is finished, False if it's paused to let others run
+    def run_slice(self, unit):
+        writer = unit.writer
+        deadline = monotonic() + self.quantum
+        try:
+            writer.load()
+        except Exception as e:
+            print(f'Error while loading state of {writer.user_id}: {e}, skipping {unit.name}...')
+            return True
+
+        with db_conn.mysql_db.connection_context():
+            if unit.pages is None:
+                print(f'Getting {unit.name}...')
+            try:
+                if unit.pages is None:
+                    unit.pages = iter(unit.fetch())
+                for data in unit.pages:
+                    job = writer.submit(unit.table, data)
+                    if job is not None:
+                        unit.jobs.append(job)
+                    writer.checkpoint(unit.table, unit.jobs)
+                    if monotonic() >= deadline and self.contended():
+                        return False
+            except Exception as e:
+                print(f'Error while getting {unit.name}: {e}, skipping...')
+                return True
+            writer.commit_written([(unit.name, unit.table, unit.jobs)], wait=True)
+        return True
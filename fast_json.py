@@ -0,0 +1,84 @@
+import json
+import re
+from datetime import datetime
+from dateutil import parser
+
+# Fast path for decoding API responses. orjson is used if installed
+# (pip install orjson), it's several times faster than json module on big
+# responses; without it everything works the same with json module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# Decoded body of API response (requests.Response or wb_api_async.ApiResponse)
+def decode(response):
+    return loads(response.content)
+
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+# Items of JSON array, in lists of up to 'size' items. Items are decoded
+# one by one, so big response (100k rows of financial report) is never
+# held as whole list of dicts and first rows may be written while the
+# rest is not decoded yet. With orjson whole array is decoded at once and
+# sliced, it's still faster (see bench_json.py). Not array (e.g. null)
+# gives nothing, or the value itself in list if it's not empty.
+def iter_array(data, size):
+    if orjson is not None:
+        value = orjson.loads(data)
+        if isinstance(value, list):
+            for start in range(0, len(value), size):
+                yield value[start:start + size]
+        elif value:
+            yield [value]
+        return
+
+    text = data.decode('utf-8') if isinstance(data, (bytes, bytearray)) else data
+    pos = _whitespace.match(text).end()
+    if text[pos:pos + 1] != '[':
+        value = loads(data)
+        if value:
+            yield value if isinstance(value, list) else [value]
+        return
+
+    pos = _whitespace.match(text, pos + 1).end()
+    if text[pos:pos + 1] == ']':
+        return
+    batch = []
+    while True:
+        item, pos = _decoder.raw_decode(text, pos)
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+        pos = _whitespace.match(text, pos).end()
+        separator = text[pos:pos + 1]
+        pos = _whitespace.match(text, pos + 1).end()
+        if separator == ']':
+            break
+        if separator != ',':
+            raise ValueError(f'Bad JSON array at position {pos}')
+    if batch:
+        yield batch
+
+
+# ISO 8601 datetime as API sends it ('2024-05-01T11:00:00Z', with offset
+# or fraction), parsed by datetime.fromisoformat, which is much faster than
+# dateutil; other formats still go to dateutil
+def parse_iso(value):
+    try:
+        if value.endswith('Z'):
+            value = value[:-1] + '+00:00'
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return parser.parse(value)
@@ -0,0 +1,84 @@
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+# Pooled keep-alive HTTP sessions, one per API host.
+# WB API is split into several hosts (content-api, statistics-api, ...), so
+# we keep a separate session with own connection pool for each of them.
+# Authorization is passed in headers on every request, so one instance can be
+# safely shared between all WBApiConn objects (and so between all threads).
+class HostSessions:
+    def __init__(self, pool_size=32, keep_alive=True, timeout=120):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+
+        self.sessions = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        # pool_block=False: if all connections are busy, extra one is opened
+        # and then discarded instead of waiting for free one
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def session(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                self.sessions[host] = self._new_session()
+                self.stats[host] = {'requests': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0}
+            return host, self.sessions[host]
+
+    def request(self, method, url, **kwargs):
+        host, session = self.session(url)
+        kwargs.setdefault('timeout', self.timeout)
+
+        start = time.monotonic()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.stats[host]['requests'] += 1
+                self.stats[host]['errors'] += 1
+                self.stats[host]['seconds'] += time.monotonic() - start
+            raise
+
+        with self.lock:
+            stats = self.stats[host]
+            stats['requests'] += 1
+            if response.status_code >= 400:
+                stats['errors'] += 1
+            stats['bytes'] += len(response.content)
+            stats['seconds'] += time.monotonic() - start
+        return response
+
+    # Per-host stats: requests made, errors, bytes received, time spent,
+    # and number of TCP connections actually opened (the rest were reused)
+    def connection_stats(self):
+        result = {}
+        with self.lock:
+            for host, session in self.sessions.items():
+                adapter = session.get_adapter(f'https://{host}')
+                pools = adapter.poolmanager.pools
+                opened = sum(pools[key].num_connections for key in pools.keys())
+                result[host] = dict(self.stats[host], connections=opened)
+        return result
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+# Default instance, shared by all WBApiConn objects created without own one
+shared_sessions = HostSessions()
@@ -0,0 +1,97 @@
+import os
+import random
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+import db_conn
+from db_conn import KeyLeases
+
+# Sharded mode: several daemon processes (on one or many hosts) share API
+# keys through KeyLeases table in the same MySQL. Process claims free keys,
+# prolongs their leases by heartbeat while working and releases them when
+# key's run is finished. If process dies, its leases expire after 'ttl'
+# and are taken over by others. Key finished less than 'min_interval' ago
+# is not claimed again, so it's processed once per cron cycle.
+# Expiry is compared with clock of every host, so ttl should be much
+# bigger than clock skew between them.
+class LeaseManager:
+    def __init__(self, ttl=300, heartbeat=60, min_interval=20 * 60, batch=100):
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.min_interval = min_interval
+        # how many keys are claimed at once
+        self.batch = batch
+        # key_ids leased by this process
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def free(self, now):
+        return (((KeyLeases.expiresAt.is_null()) | (KeyLeases.expiresAt < now))
+                & ((KeyLeases.finishedAt.is_null())
+                   | (KeyLeases.finishedAt < now - timedelta(seconds=self.min_interval))))
+
+    # Claim up to 'batch' free keys out of key_ids, returns claimed ones
+    def claim(self, key_ids):
+        now = datetime.now()
+        with db_conn.mysql_db.connection_context():
+            for start in range(0, len(key_ids), 1000):
+                KeyLeases.insert_many([{'key_id': key_id} for key_id in key_ids[start:start + 1000]],
+                                      fields=[KeyLeases.key_id]).on_conflict_ignore().execute()
+
+            candidates = [lease.key_id for lease in
+                          KeyLeases.select(KeyLeases.key_id).where(KeyLeases.key_id.in_(key_ids) & self.free(now))]
+            # other processes claim at the same time, so don't all go in the same order
+            random.shuffle(candidates)
+
+            claimed = []
+            for key_id in candidates:
+                if len(claimed) >= self.batch:
+                    break
+                # the condition is checked again by UPDATE itself, so only
+                # one process gets the key
+                updated = (KeyLeases.update(owner=self.owner, expiresAt=now + timedelta(seconds=self.ttl))
+                           .where((KeyLeases.key_id == key_id) & self.free(now)).execute())
+                if updated:
+                    claimed.append(key_id)
+        with self.lock:
+            self.held.update(claimed)
+        return claimed
+
+    # Lock is held during DB update, so heartbeat doesn't prolong lease
+    # which is being released
+    def release(self, key_id):
+        with self.lock, db_conn.mysql_db.connection_context():
+            self.held.discard(key_id)
+            (KeyLeases.update(expiresAt=None, finishedAt=datetime.now())
+             .where((KeyLeases.key_id == key_id) & (KeyLeases.owner == self.owner)).execute())
+
+    # Prolong leases of held keys
+    def beat(self):
+        with self.lock:
+            held = list(self.held)
+            if not held:
+                return
+            with db_conn.mysql_db.connection_context():
+                updated = (KeyLeases.update(expiresAt=datetime.now() + timedelta(seconds=self.ttl))
+                           .where(KeyLeases.key_id.in_(held) & (KeyLeases.owner == self.owner)).execute())
+        if updated < len(held):
+            print(f'WARNING: {len(held) - updated} leases of {self.owner} were taken over by other workers')
+
+    def start(self):
+        def loop():
+            while not self.stopped.wait(self.heartbeat):
+                try:
+                    self.beat()
+                except Exception as e:
+                    print(f'Error while prolonging leases: {e}')
+        self.thread = threading.Thread(target=loop, name='lease-heartbeat', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,112 @@
+import json
+from datetime import datetime, date
+from functools import lru_cache
+from peewee import DateTimeField, DateField, BooleanField
+from playhouse.mysql_ext import JSONField
+
+# API sends datetimes as ISO 8601 strings, sometimes with timezone or 'Z'.
+# Older MySQL doesn't accept offsets, so keep wall time as naive datetime.
+# The same dates repeat in thousands of rows, so parsed values are cached
+@lru_cache(maxsize=65536)
+def _parse_datetime(value):
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=None)
+    except ValueError:
+        return value
+
+
+@lru_cache(maxsize=65536)
+def _parse_date(value):
+    try:
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        return value
+
+
+def to_datetime(value):
+    return _parse_datetime(value) if isinstance(value, str) else value
+
+
+def to_date(value):
+    return _parse_date(value) if isinstance(value, str) else value
+
+
+def to_bool(value):
+    return value if value is None else bool(value)
+
+
+def to_json(value):
+    return value if value is None else json.dumps(value, ensure_ascii=False)
+
+
+COERCE = {
+    DateTimeField: to_datetime,
+    DateField: to_date,
+    BooleanField: to_bool,
+    JSONField: to_json,
+}
+
+
+# Turns API rows (dicts) into insert tuples for one model, ready for DB driver.
+# Built once from model fields: keys missing in row become None, keys
+# not in model are ignored, so API may add new fields without breaking us.
+class RowProjector:
+    def __init__(self, model):
+        self.model = model
+        self.fields = [field for field in model._meta.sorted_fields if not field.primary_key]
+        self.names = [field.name for field in self.fields]
+        self.user_index = self.names.index('UserID')
+        # (index in tuple, coerce function) for fields needing conversion
+        self.coerce = [(i, COERCE[type(field)]) for i, field in enumerate(self.fields)
+                       if type(field) in COERCE]
+        self.statements = {}
+
+    def project(self, data_array, user_id):
+        names = self.names
+        user_index = self.user_index
+        coerce = self.coerce
+
+        result = []
+        for data in data_array:
+            row = list(map(data.get, names))
+            row[user_index] = user_id
+            for i, func in coerce:
+                row[i] = func(row[i])
+            result.append(tuple(row))
+        return result
+
+    def index(self, name):
+        return self.names.index(name)
+
+    # Multi-row INSERT for rows of this model: (prefix, row placeholder, suffix).
+    # mode is 'replace' (REPLACE INTO) or 'upsert' (ON DUPLICATE KEY UPDATE).
+    # Built by hand: peewee wraps every value in expression objects, which
+    # for ~75 columns x 5000 rows takes longer than the query itself
+    def statement(self, database, mode):
+        if mode not in self.statements:
+            table = self.model._meta.table_name
+            columns = [field.column_name for field in self.fields]
+            column_list = ', '.join(f'`{column}`' for column in columns)
+            verb = 'INSERT' if mode == 'upsert' else 'REPLACE'
+            prefix = f'{verb} INTO `{table}` ({column_list}) VALUES '
+            placeholder = '(' + ', '.join([database.param] * len(columns)) + ')'
+            suffix = ''
+            if mode == 'upsert':
+                suffix = ' ON DUPLICATE KEY UPDATE ' + ', '.join(f'`{column}` = VALUES(`{column}`)'
+                                                                 for column in columns)
+            self.statements[mode] = (prefix, placeholder, suffix)
+        return self.statements[mode]
+
+    def insert_sql(self, database, mode, rows_count):
+        prefix, placeholder, suffix = self.statement(database, mode)
+        return prefix + ', '.join([placeholder] * rows_count) + suffix
+
+
+_projectors = {}
+
+# Cached projector of model
+def projector_for(model):
+    projector = _projectors.get(model)
+    if projector is None:
+        projector = _projectors[model] = RowProjector(model)
+    return projector
@@ -0,0 +1,125 @@
+import threading
+import time
+
+# Default limits for endpoint groups: (requests per second, burst) or
+# (requests per second, burst, max rate to probe) for groups where real
+# limit is often higher than documented one, see TokenBucket.
+# Taken from WB API docs, can be overridden with 'rate_limits' in config.
+LIMITS = {
+    'cards': (100 / 60, 5),            # 100 requests per minute
+    'prices': (10 / 6, 10),            # 10 requests per 6 seconds
+    'orders': (1 / 60, 1),             # 1 request per minute
+    'sales': (1 / 60, 1),              # 1 request per minute
+    'finance': (1 / 60, 1),            # 1 request per minute
+    'warehouse': (1 / 60, 1),          # create report: 1 request per minute
+    'warehouse_status': (1 / 5, 1),    # report status: 1 request per 5 seconds
+    'warehouse_download': (1 / 60, 1), # download report: 1 request per minute
+    'adverts': (5, 5),                 # 5 requests per second
+    'fullstats': (1 / 60, 1, 3 / 60),  # 1 request per minute, up to 3 if server allows
+    'calendar': (10 / 6, 10),          # 10 requests per 6 seconds
+}
+DEFAULT_LIMIT = (1, 1)
+
+
+# With 'ceiling', rate is learned from responses: every successful one
+# raises it by quarter of documented rate up to ceiling, 429 halves it and
+# lowers ceiling below the rate that was refused, so rate settles at what
+# server really allows (but not lower than documented).
+class TokenBucket:
+    def __init__(self, rate, burst, ceiling=None):
+        self.rate = rate
+        self.burst = burst
+        self.base_rate = rate
+        self.ceiling = ceiling
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # set by server hints (429, X-Ratelimit-*), nothing is sent before it
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Take one token and return how long to wait before using it.
+    # Tokens may go negative: that's queue of callers waiting for their slot.
+    def reserve(self, now):
+        self._refill(now)
+        self.tokens -= 1
+        wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def block(self, now, seconds):
+        self._refill(now)
+        self.tokens = min(self.tokens, 0)
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def adapt(self, now, throttled):
+        if self.ceiling is None:
+            return
+        self._refill(now)
+        step = self.base_rate / 4
+        if throttled:
+            self.ceiling = max(self.base_rate, self.rate - step)
+            self.rate = max(self.base_rate, self.rate / 2)
+        else:
+            self.rate = min(self.ceiling, self.rate + step)
+
+
+def _header_float(headers, name):
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# Central rate limiter for WB API, bucket per (host, endpoint group, token).
+# Shared between all connectors (and threads) that use the same token,
+# so parallel workers don't exceed the quota together.
+class RateLimiter:
+    def __init__(self, limits=None):
+        self.limits = dict(LIMITS)
+        self.limits.update(limits or {})
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def set_limits(self, limits):
+        with self.lock:
+            self.limits.update({group: tuple(limit) for group, limit in limits.items()})
+            self.buckets.clear()
+
+    def _bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*self.limits.get(key[1], DEFAULT_LIMIT))
+        return bucket
+
+    # Seconds to wait before request, caller must sleep them (sync or async)
+    def reserve(self, key):
+        with self.lock:
+            return self._bucket(key).reserve(time.monotonic())
+
+    # Adjust bucket by response: honor 429 with Retry-After / X-Ratelimit-Retry
+    # and X-Ratelimit-Remaining / X-Ratelimit-Reset sent by WB
+    def observe(self, key, response):
+        headers = response.headers
+        retry = _header_float(headers, 'Retry-After')
+        if retry is None:
+            retry = _header_float(headers, 'X-Ratelimit-Retry')
+        remaining = _header_float(headers, 'X-Ratelimit-Remaining')
+        reset = _header_float(headers, 'X-Ratelimit-Reset')
+
+        with self.lock:
+            bucket = self._bucket(key)
+            now = time.monotonic()
+            bucket.adapt(now, response.status_code == 429)
+            if response.status_code == 429:
+                bucket.block(now, retry if retry is not None else 1 / bucket.rate)
+            elif remaining is not None:
+                bucket._refill(now)
+                bucket.tokens = min(bucket.tokens, remaining)
+                if remaining <= 0 and reset is not None:
+                    bucket.block(now, reset)
+
+
+# Default instance, shared by all WBApiConn objects created without own one
+shared_limiter = RateLimiter()
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+from time import monotonic
+from wb_api_async import AsyncWBApiConn, new_http_session
+
+# Warehouse report of one key, generated by API while writer does other work
+class Report:
+    def __init__(self, token):
+        self.token = token
+        self.task_id = None
+        # 'pending', then 'done', 'error' or 'timeout'
+        self.status = 'pending'
+        # set when status is final
+        self.ready = threading.Event()
+        self.callbacks = []
+
+    def finish(self, status):
+        self.status = status
+        self.ready.set()
+        for callback in self.callbacks:
+            callback()
+
+
+# Warehouse report is generated on server for up to minutes, and polling
+# it from writer's thread keeps the thread idle all this time. Instead,
+# tasks of all keys are created up front and polled together in one
+# background event loop, with growing delay between polls and timeout;
+# writer downloads its report when it's ready (see Writer.iter_warehouses_report).
+class ReportPoller:
+    def __init__(self, first_delay=5, max_delay=60, timeout=600, http=None):
+        self.first_delay = first_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        # aiohttp session parameters, see wb_api_async.new_http_session
+        self.http_config = http or {}
+        self.stats = {'reports': 0, 'done': 0, 'error': 0, 'timeout': 0, 'polls': 0}
+        self.loop = None
+        self.thread = None
+        self.stopping = None
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.main(started))
+            self.loop.close()
+        self.thread = threading.Thread(target=run, name='report-poller', daemon=True)
+        self.thread.start()
+        started.wait()
+
+    async def main(self, started):
+        # session must be created inside running event loop
+        async with new_http_session(**self.http_config) as self.http:
+            self.stopping = asyncio.Event()
+            started.set()
+            await self.stopping.wait()
+
+    # Start report of token in background, callback is called when it's
+    # ready (or failed), from poller's thread
+    def submit(self, token, callback=None):
+        report = Report(token)
+        if callback is not None:
+            report.callbacks.append(callback)
+        asyncio.run_coroutine_threadsafe(self.poll(report), self.loop)
+        return report
+
+    async def poll(self, report):
+        # stats are changed only in poller's thread
+        self.stats['reports'] += 1
+        conn = AsyncWBApiConn(report.token, self.http)
+        status = 'error'
+        try:
+            report.task_id = await conn.start_warehouse_report()
+            if report.task_id is not None:
+                delay = self.first_delay
+                deadline = monotonic() + self.timeout
+                while True:
+                    await asyncio.sleep(delay)
+                    self.stats['polls'] += 1
+                    ready = await conn.warehouse_report_ready(report.task_id)
+                    if ready is None:
+                        break
+                    if ready:
+                        status = 'done'
+                        break
+                    if monotonic() + delay > deadline:
+                        print(f'Warehouse report {report.task_id} is not ready in {self.timeout} seconds, skipping...')
+                        status = 'timeout'
+                        break
+                    delay = min(delay * 2, self.max_delay)
+        except Exception as e:
+            print(f'Error while polling warehouse report: {e}')
+        self.stats[status] += 1
+        report.finish(status)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopping.set)
+        self.thread.join()
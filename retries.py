@@ -0,0 +1,53 @@
+import random
+import threading
+
+# Statuses worth another attempt, others are returned to the caller as is
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+# Exponential backoff with full jitter, limited by attempts and total time
+class RetryPolicy:
+    def __init__(self, base=1, cap=60, max_elapsed=600, max_attempts=8):
+        self.base = base
+        self.cap = cap
+        self.max_elapsed = max_elapsed
+        self.max_attempts = max_attempts
+
+    def configure(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    # Seconds to wait before next attempt, or None to give up.
+    # On 429 rate limiter already holds the next call as long as server asked,
+    # so only small jitter is added to spread callers of the same token.
+    def delay(self, attempt, elapsed, throttled=False):
+        if attempt + 1 >= self.max_attempts:
+            return None
+        if throttled:
+            delay = random.uniform(0, self.base)
+        else:
+            delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        if elapsed + delay > self.max_elapsed:
+            return None
+        return delay
+
+
+# Counters of retries and give-ups per endpoint group
+class RetryStats:
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add(self, group, counter):
+        with self.lock:
+            stats = self.counters.setdefault(group, {'retries': 0, 'give_ups': 0})
+            stats[counter] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {group: dict(stats) for group, stats in self.counters.items()}
+
+
+# Default instances, shared by all WBApiConn objects
+shared_policy = RetryPolicy()
+shared_stats = RetryStats()
@@ -0,0 +1,58 @@
+import hashlib
+from playhouse.migrate import SchemaMigrator, migrate
+
+# Schema changes without touching DB on every run: models are fingerprinted,
+# and tables are checked only if fingerprint differs from the stored one.
+# Then missing tables are created and missing columns and indexes are added
+# to existing tables; nothing is dropped or altered.
+
+# Fingerprint of models: tables, columns with types and indexes
+def schema_version(models):
+    parts = []
+    for model in sorted(models, key=lambda model: model._meta.table_name):
+        parts.append(model._meta.table_name)
+        parts.extend(f'{field.column_name} {field.field_type} {field.null}' for field in model._meta.sorted_fields)
+        parts.extend(f'{fields} {unique}' for fields, unique in model._meta.indexes)
+    return hashlib.md5('\n'.join(parts).encode()).hexdigest()
+
+
+# MySQL names are case-insensitive
+def _lower(names):
+    return tuple(name.lower() for name in names)
+
+
+# Returns False if some changes failed
+def migrate_tables(database, models):
+    existing = {table.lower() for table in database.get_tables()}
+    database.create_tables([model for model in models if model._meta.table_name.lower() not in existing])
+
+    migrator = SchemaMigrator.from_database(database)
+    ok = True
+    for model in models:
+        table = model._meta.table_name
+        if table.lower() not in existing:
+            continue
+
+        operations = []
+        columns = {column.name.lower() for column in database.get_columns(table)}
+        for field in model._meta.sorted_fields:
+            if field.column_name.lower() not in columns:
+                print(f'Adding column {table}.{field.column_name}')
+                operations.append(migrator.add_column(table, field.column_name, field))
+
+        indexes = {_lower(index.columns) for index in database.get_indexes(table)}
+        for fields, unique in model._meta.indexes:
+            columns = [model._meta.fields[name].column_name for name in fields]
+            if _lower(columns) not in indexes:
+                print(f'Adding index {table}{tuple(columns)}')
+                operations.append(migrator.add_index(table, columns, unique))
+
+        for operation in operations:
+            try:
+                migrate(operation)
+            except Exception as e:
+                # e.g. unique index over duplicated rows: go on with other
+                # tables, version is not saved, so it's tried again next time
+                print(f'Error while migrating {table}: {e}')
+                ok = False
+    return ok
@@ -0,0 +1,167 @@
+import random
+import signal
+import threading
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+import db_conn
+
+# Resident mode: instead of cron starting daemon every 30 minutes, one
+# process keeps writers, HTTP sessions, caches and DB pool and runs every
+# (API key, endpoint) on its own schedule. Start times are spread with
+# jitter, so users don't hit API all at once. Writer of one key never runs
+# twice at once: if run takes longer than interval, the next one starts
+# right after it, missed slots are not caught up.
+class Service:
+    def __init__(self, sessions=None, write_queue=None, reports=None, write_mode='replace', interval=30 * 60,
+                 daily_interval=24 * 60 * 60, jitter=60, refresh=5 * 60, workers=32):
+        self.sessions = sessions
+        self.write_queue = write_queue
+        self.reports = reports
+        self.write_mode = write_mode
+        # seconds between runs of usual and daily endpoints (see db_conn.DAILY)
+        self.interval = interval
+        self.daily_interval = daily_interval
+        # random shift of every run, in seconds
+        self.jitter = jitter
+        # how often APIKeys are read again to find new and removed keys
+        self.refresh = refresh
+        # how many writers run at once
+        self.workers = workers
+
+        # key_id -> (api_key, Writer)
+        self.writers = {}
+        # (key_id, endpoint name) -> monotonic time of next run
+        self.schedule = {}
+        # key_id -> {endpoint name: names of endpoints it depends on}
+        self.after = {}
+        # key_id -> names of endpoints not run yet; APIKeys.runs of key is
+        # counted only after all of them have run once
+        self.not_run = {}
+        # key_ids of writers running now
+        self.running = set()
+        self.lock = threading.Lock()
+        # set when writer finishes or service is stopped, to wake up loop
+        self.wake = threading.Event()
+        self.stopping = False
+
+    def interval_of(self, name):
+        return self.daily_interval if name in db_conn.DAILY else self.interval
+
+    # Read APIKeys: start schedules for new keys, forget removed ones
+    def load_keys(self):
+        with db_conn.mysql_db.connection_context():
+            api_keys = list(db_conn.APIKeys.select())
+
+        now = monotonic()
+        with self.lock:
+            for obj in api_keys:
+                known = self.writers.get(obj.key_id)
+                if known is not None and known[0] == obj.api_key:
+                    continue
+                if obj.key_id in self.running:
+                    # key was changed, pick it up after current run
+                    continue
+                writer = db_conn.Writer(obj.api_key, obj.user_id, obj.runs or 0, self.sessions,
+                                        self.write_mode, self.write_queue, self.reports)
+                self.writers[obj.key_id] = (obj.api_key, writer)
+                endpoints = writer.all_endpoints()
+                self.after[obj.key_id] = {name: after for name, table, fetch, after in endpoints}
+                self.not_run[obj.key_id] = {endpoint[0] for endpoint in endpoints}
+                # the first run of every endpoint, spread by jitter; endpoint
+                # starts together with endpoints it depends on (they're
+                # earlier in the list)
+                for name, table, fetch, after in endpoints:
+                    at = now + random.uniform(0, self.jitter)
+                    for dependency in after:
+                        at = self.schedule.get((obj.key_id, dependency), at)
+                    self.schedule[(obj.key_id, name)] = at
+
+            removed = set(self.writers) - {obj.key_id for obj in api_keys} - self.running
+            for key_id in removed:
+                del self.writers[key_id]
+                del self.after[key_id]
+                del self.not_run[key_id]
+            for key in [key for key in self.schedule if key[0] in removed]:
+                del self.schedule[key]
+
+    # Names of endpoints of key that should be updated now, with endpoints
+    # they depend on (e.g. promos stats needs IDs from product adverts)
+    def due(self, key_id, now):
+        result = {name for (key, name), at in self.schedule.items() if key == key_id and at <= now}
+        after = self.after.get(key_id, {})
+        for name in list(result):
+            result.update(after.get(name, ()))
+        return result
+
+    def run_writer(self, key_id, writer, due):
+        try:
+            writer.run(due)
+        except Exception as e:
+            print(f'Error while running writer of key {key_id}: {e}')
+
+        # next run is counted from scheduled time, not from the end of the
+        # run, so cadence doesn't drift; overrun runs are not repeated
+        now = monotonic()
+        with self.lock:
+            for name in due:
+                at = self.schedule.get((key_id, name))
+                if at is None:
+                    continue
+                at += self.interval_of(name) + random.uniform(-self.jitter, self.jitter)
+                self.schedule[(key_id, name)] = max(at, now)
+            self.running.discard(key_id)
+            not_run = self.not_run.get(key_id)
+            if not_run:
+                not_run.difference_update(due)
+                # the first full run of key is counted when its last endpoint has run
+                counted = not not_run
+            else:
+                counted = not_run is not None
+        self.wake.set()
+
+        if not counted:
+            return
+        writer.run_number += 1
+        try:
+            db_conn.count_run(key_id)
+        except Exception as e:
+            print(f'Error while updating runs of key {key_id}: {e}')
+
+    def stop(self, *args):
+        print('Stopping, waiting for running writers to finish...')
+        self.stopping = True
+        self.wake.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        next_refresh = 0
+        with ThreadPoolExecutor(self.workers) as executor:
+            while not self.stopping:
+                now = monotonic()
+                if now >= next_refresh:
+                    try:
+                        self.load_keys()
+                    except Exception as e:
+                        print(f'Error while reading API keys: {e}')
+                    next_refresh = now + self.refresh
+
+                with self.lock:
+                    for key_id, (api_key, writer) in self.writers.items():
+                        if key_id in self.running:
+                            continue
+                        due = self.due(key_id, now)
+                        if due:
+                            self.running.add(key_id)
+                            executor.submit(self.run_writer, key_id, writer, due)
+                    waiting = [at for (key_id, name), at in self.schedule.items()
+                               if key_id not in self.running]
+
+                # sleep until the next scheduled run, refresh of keys or
+                # end of some run
+                timeout = min(waiting + [next_refresh]) - monotonic()
+                self.wake.wait(max(timeout, 0))
+                self.wake.clear()
+        # leaving 'with' waits for running writers
+        print('Service stopped')
@@ -0,0 +1,175 @@
+import asyncio
+from time import monotonic
+from itertools import count
+import aiohttp
+from wb_api import WBApiConn, Sleep, Page, Fanout
+import fast_json
+
+# Minimal response object, enough for flows (same attributes as requests.Response)
+class ApiResponse:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return fast_json.loads(self.content)
+
+
+# aiohttp doesn't accept bool and list values in params, so encode them
+# the same way requests does: str() for scalars, repeated key for lists
+def encode_params(params):
+    result = []
+    for key, value in (params or {}).items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        result.extend((key, str(item)) for item in values)
+    return result
+
+
+# Asyncio connector for Wildberries API.
+# Runs the same flows as WBApiConn, but awaits responses and sleeps, so one
+# event loop can serve thousands of tokens at once.
+class AsyncWBApiConn(WBApiConn):
+    def __init__(self, token, http, limiter=None, retry=None):
+        super().__init__(token, limiter=limiter, retry=retry)
+        # aiohttp.ClientSession, shared between connectors
+        self.http = http
+
+    async def _request(self, method, url, group=None, **kwargs):
+        key = self._limit_key(url, group)
+        kwargs['params'] = encode_params(kwargs.get('params'))
+        start = monotonic()
+        for attempt in count():
+            await asyncio.sleep(self.limiter.reserve(key))
+            response, error = None, None
+            try:
+                async with self.http.request(method, url, headers=self.headers, **kwargs) as raw_response:
+                    content = await raw_response.read()
+                    response = ApiResponse(raw_response.status, raw_response.headers, content)
+                self.limiter.observe(key, response)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+
+            delay = self._backoff(group, attempt, start, response, error)
+            if delay is None:
+                return response
+            await asyncio.sleep(delay)
+
+    # Execute flow with asyncio I/O, yield its pages as soon as they arrive
+    async def _iter(self, flow):
+        reply = None
+        while True:
+            try:
+                step = flow.send(reply)
+            except StopIteration:
+                return
+
+            reply = None
+            if isinstance(step, Page):
+                yield step.rows
+            elif isinstance(step, Sleep):
+                await asyncio.sleep(step.seconds)
+            elif isinstance(step, Fanout):
+                reply = await self._fanout(step.calls)
+            else:
+                reply = await self._request(step.method, step.url, step.group, **step.kwargs)
+
+    # Execute flow and return all its rows at once
+    async def _run(self, flow):
+        return [row async for page in self._iter(flow) for row in page]
+
+    # Execute flow without pages and return its result
+    async def _value(self, flow):
+        reply = None
+        while True:
+            try:
+                step = flow.send(reply)
+            except StopIteration as stop:
+                return stop.value
+
+            reply = None
+            if isinstance(step, Sleep):
+                await asyncio.sleep(step.seconds)
+            elif isinstance(step, Fanout):
+                reply = await self._fanout(step.calls)
+            elif not isinstance(step, Page):
+                reply = await self._request(step.method, step.url, step.group, **step.kwargs)
+
+    async def _fanout(self, calls):
+        semaphore = asyncio.Semaphore(self.fanout_workers)
+
+        async def request(call):
+            async with semaphore:
+                return await self._request(call.method, call.url, call.group, **call.kwargs)
+        return await asyncio.gather(*(request(call) for call in calls))
+
+    # Start warehouse report generation, returns task ID (None on error)
+    async def start_warehouse_report(self):
+        return await self._value(self._warehouse_task_flow())
+
+    # Whether warehouse report is generated (None on error)
+    async def warehouse_report_ready(self, report_id):
+        return await self._value(self._warehouse_status_flow(report_id))
+
+    # iter_* methods are async generators, yielding result page by page
+    def iter_product_cards(self):
+        return self._iter(self._product_cards_flow())
+
+    def iter_product_prices(self):
+        return self._iter(self._product_prices_flow())
+
+    def iter_stats(self, type, first_use=False):
+        return self._iter(self._stats_flow(type, first_use))
+
+    def iter_warehouses_report(self):
+        return self._iter(self._warehouses_report_flow())
+
+    def iter_financial_report(self, first_use=False):
+        return self._iter(self._financial_report_flow(first_use))
+
+    def iter_adv_deatils(self, first_use=False):
+        return self._iter(self._adv_deatils_flow(first_use))
+
+    def iter_prom_stats(self, first_use=False):
+        return self._iter(self._prom_stats_flow(first_use))
+
+    def iter_promo_calendar(self):
+        return self._iter(self._promo_calendar_flow())
+
+    async def get_product_cards(self) -> list:
+        return await self._run(self._product_cards_flow())
+
+    async def get_product_prices(self) -> list:
+        return await self._run(self._product_prices_flow())
+
+    async def get_stats(self, type, first_use=False) -> list:
+        return await self._run(self._stats_flow(type, first_use))
+
+    async def get_warehouses_report(self) -> list:
+        return await self._run(self._warehouses_report_flow())
+
+    async def get_financial_report(self, first_use=False) -> list:
+        return await self._run(self._financial_report_flow(first_use))
+
+    async def get_adv_list(self):
+        await self._run(self._adv_list_flow())
+
+    async def get_adv_deatils(self, first_use=False) -> list:
+        return await self._run(self._adv_deatils_flow(first_use))
+
+    async def get_prom_stats(self, first_use=False) -> list:
+        return await self._run(self._prom_stats_flow(first_use))
+
+    async def get_promo_calendar(self) -> list:
+        return await self._run(self._promo_calendar_flow())
+
+
+# Shared aiohttp session with keep-alive connections.
+# Must be created inside running event loop.
+def new_http_session(pool_size=100, keep_alive=True, timeout=120):
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=pool_size, force_close=not keep_alive)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout))
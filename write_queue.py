@@ -0,0 +1,109 @@
+import queue
+import threading
+from time import monotonic
+import db_conn
+
+# Bounded queue between fetching and writing. Writers (fetchers) put
+# prepared pages (WriteJob) and go on with API calls, while a few DB writer
+# threads drain the queue. Jobs of the same table waiting in queue, from any
+# user, are merged into one transaction. When DB is slower than API, the
+# queue fills up and put() blocks fetchers (backpressure), so memory stays
+# bounded by 'size' pages.
+class WriteQueue:
+    def __init__(self, size=64, writers=4, max_merge=32):
+        self.queue = queue.Queue(size)
+        self.writers = writers
+        # at most this many jobs are merged into one transaction
+        self.max_merge = max_merge
+        self.threads = []
+        self.stats = {'jobs': 0, 'transactions': 0, 'errors': 0, 'peak_depth': 0,
+                      'blocked_puts': 0, 'blocked_seconds': 0.0}
+        self.lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.writers):
+            thread = threading.Thread(target=self.work, name=f'db-writer-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, job):
+        start = None
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            start = monotonic()
+            self.queue.put(job)
+        with self.lock:
+            self.stats['jobs'] += 1
+            self.stats['peak_depth'] = max(self.stats['peak_depth'], self.queue.qsize())
+            if start is not None:
+                self.stats['blocked_puts'] += 1
+                self.stats['blocked_seconds'] += monotonic() - start
+
+    # Metrics with current queue depth; jobs / transactions shows how well
+    # pages are merged
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, depth=self.queue.qsize())
+
+    # Write all queued jobs and stop DB writers
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def work(self):
+        while True:
+            jobs = [self.queue.get()]
+            # take everything else already waiting, without blocking
+            while jobs[-1] is not None and len(jobs) < self.max_merge:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = jobs[-1] is None
+            if stop:
+                jobs.pop()
+
+            groups = {}
+            for job in jobs:
+                groups.setdefault((job.table, job.mode), []).append(job)
+            try:
+                with db_conn.mysql_db.connection_context():
+                    for group in groups.values():
+                        self.write(group)
+            except Exception as e:
+                # no connection to DB: fail jobs so fetchers don't wait forever
+                for job in jobs:
+                    if not job.done.is_set():
+                        job.error = e
+                        job.done.set()
+            if stop:
+                return
+
+    def write(self, jobs):
+        try:
+            db_conn.write_jobs(jobs)
+            transactions, errors = 1, 0
+        except Exception as e:
+            if len(jobs) == 1:
+                jobs[0].error = e
+                transactions, errors = 0, 1
+            else:
+                # one bad page should not fail pages of other users,
+                # so write them one by one
+                transactions, errors = 0, 0
+                for job in jobs:
+                    try:
+                        db_conn.write_jobs([job])
+                        transactions += 1
+                    except Exception as e:
+                        job.error = e
+                        errors += 1
+        with self.lock:
+            self.stats['transactions'] += transactions
+            self.stats['errors'] += errors
+        for job in jobs:
+            job.done.set()